@@ -1,12 +1,15 @@
 import os
 import json
 import sys
+import queue
+import shutil
 import threading
 import pandas as pd
+from collections import deque
 from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from monet_engine import MoNetEngine
+from monet_engine import MoNetEngine, write_csv
 
 # --- SETUP PATHS ---
 if getattr(sys, 'frozen', False):
@@ -33,22 +36,49 @@ def save_settings(key, value):
     with open(SETTINGS_FILE, "w") as f: json.dump(current, f, indent=2)
     return current
 
-def scan_folder(folder):
-    items = []
+def scan_folder(folder, workers=16):
+    # os.scandir skips the per-file stat that os.walk pays, and the
+    # thread fan-out overlaps directory I/O latency (big win on NFS).
     folder_path = Path(folder)
-    for r, _, files in os.walk(folder):
-        for f in files:
-            if f.lower().endswith(".csv"):
-                full_path = Path(r) / f
-                try:
-                    rel_path = full_path.relative_to(folder_path)
-                except:
-                    rel_path = Path(f)
-                items.append({
-                    "file_name": f, "rel_path": rel_path,
-                    "full_path": str(full_path)
-                })
-    return sorted(items, key=lambda x: x["rel_path"])
+    results = []
+    lock = threading.Lock()
+    pending = queue.Queue()
+    pending.put(str(folder_path))
+
+    def drain():
+        while True:
+            d = pending.get()
+            if d is None:
+                pending.task_done()
+                break
+            local = []
+            try:
+                with os.scandir(d) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False):
+                            pending.put(e.path)
+                        elif e.name.lower().endswith(".csv"):
+                            full_path = Path(e.path)
+                            try:
+                                rel_path = full_path.relative_to(folder_path)
+                            except ValueError:
+                                rel_path = Path(e.name)
+                            local.append({
+                                "file_name": e.name, "rel_path": rel_path,
+                                "full_path": str(full_path)
+                            })
+            except OSError:
+                pass  # Unreadable dir — skip it like os.walk would
+            if local:
+                with lock: results.extend(local)
+            pending.task_done()
+
+    threads = [threading.Thread(target=drain, daemon=True) for _ in range(workers)]
+    for t in threads: t.start()
+    pending.join()  # All discovered dirs processed
+    for _ in threads: pending.put(None)
+    for t in threads: t.join()
+    return sorted(results, key=lambda x: x["rel_path"])
 
 # --- GUI ---
 class MoNetApp(tk.Tk):
@@ -57,7 +87,7 @@ class MoNetApp(tk.Tk):
         self.title("MoNet-Analyzer")
         self.geometry("950x780")
         
-        self.engine = MoNetEngine()
+        self.engine = MoNetEngine(cache_dir=str(BASE_DIR / ".monet_cache"))
         self.settings = load_settings()
         self.paths = {"input": tk.StringVar(value=self.settings["last_input"])}
         
@@ -66,9 +96,23 @@ class MoNetApp(tk.Tk):
         self.explain_text = tk.StringVar()
         self.stop_flag = False
         self.items = []
+        self._row_by_name = {}  # filename -> tree item id, O(1) row updates
+        # Coalescing buffers: workers append, the Tk loop flushes every
+        # 50ms. Both are deques — their append/popleft are atomic, so
+        # worker threads never race the flush.
+        self._log_buf = deque()
+        self._log_pending = False
+        self._row_buf = deque()
+        self._rows_pending = False
         
         self._ui()
-        self._update_explanation() 
+        self._update_explanation()
+
+        # Start loading the model now so it's warm by the first RUN click
+        self._preload_started = False
+        if DEFAULT_MODEL_PATH.exists():
+            self._preload_started = True
+            threading.Thread(target=self.engine.load_model, args=(str(DEFAULT_MODEL_PATH),), daemon=True).start()
 
     def _ui(self):
         nb = ttk.Notebook(self); nb.pack(fill="both", expand=1, padx=10, pady=5)
@@ -126,22 +170,50 @@ class MoNetApp(tk.Tk):
         try:
             self.items = scan_folder(self.paths["input"].get())
             self.tree.delete(*self.tree.get_children())
-            for item in self.items: self.tree.insert("", "end", values=(item["file_name"], "Pending", "-", "-"))
+            self._row_by_name.clear()
+            for item in self.items:
+                iid = self.tree.insert("", "end", values=(item["file_name"], "Pending", "-", "-"))
+                self._row_by_name[item["file_name"]] = iid
             self.lbl_count.config(text=f"Found {len(self.items)} CSV files.")
             messagebox.showinfo("Scan", f"Found {len(self.items)} files.")
         except Exception as e: messagebox.showerror("Error", str(e))
 
     def _log(self, msg):
+        # Buffer + flush on the Tk loop: thread-safe AND one widget
+        # update per 50ms instead of three Tk ops per message
+        self._log_buf.append(msg)
+        if not self._log_pending:
+            self._log_pending = True
+            self.after(50, self._flush_log)
+
+    def _flush_log(self):
+        self._log_pending = False
+        if not self._log_buf: return
+        msgs = []
+        while self._log_buf:
+            msgs.append(self._log_buf.popleft())
         self.log_text.config(state="normal")
-        self.log_text.insert("end", msg + "\n")
+        self.log_text.insert("end", "\n".join(msgs) + "\n")
         self.log_text.see("end")
         self.log_text.config(state="disabled")
 
     def _update_row(self, filename, status, total="-", filtered="-"):
-        for item in self.tree.get_children():
-            if self.tree.item(item)["values"][0] == filename:
-                self.tree.item(item, values=(filename, status, total, filtered))
-                break
+        self._row_buf.append((filename, (status, total, filtered)))
+        if not self._rows_pending:
+            self._rows_pending = True
+            self.after(50, self._flush_rows)
+
+    def _flush_rows(self):
+        self._rows_pending = False
+        # Dedupe at flush time: only the latest state per file matters
+        pending = {}
+        while self._row_buf:
+            filename, values = self._row_buf.popleft()
+            pending[filename] = values
+        for filename, (status, total, filtered) in pending.items():
+            iid = self._row_by_name.get(filename)
+            if iid is not None:
+                self.tree.item(iid, values=(filename, status, total, filtered))
 
     def _stop_batch(self):
         self.stop_flag = True
@@ -161,6 +233,10 @@ class MoNetApp(tk.Tk):
 
         def worker():
             self._log(f"🚀 Starting Batch Analysis...")
+            if not self.engine.is_loaded():
+                self._log(f"🧠 Loading Model: {DEFAULT_MODEL_PATH.name}...")
+                if self._preload_started:
+                    self.engine.load_event.wait()  # Startup preload in flight
             success, msg = self.engine.load_model(str(DEFAULT_MODEL_PATH))
             if not success: self._log(f"❌ CRITICAL ERROR: {msg}"); self._reset_buttons(); return
 
@@ -170,35 +246,184 @@ class MoNetApp(tk.Tk):
                     f.write(f"Source: {input_root}\nFilter: {filter_mode}\nModel: {DEFAULT_MODEL_PATH.name}\n")
             except Exception as e: self._log(f"❌ Error creating folder: {e}"); self._reset_buttons(); return
 
-            for item in self.items:
-                if self.stop_flag: self._log("🛑 Batch stopped by user."); break
-                fname = item["file_name"]
-                self._update_row(fname, "Running...")
-                self._log(f"⏳ Processing {fname}...")
-                
-                filtered_df, count_orig, count_filt, msg = self.engine.run_inference(item["full_path"], filter_mode)
-
-                if filtered_df is None:
-                    self._log(f"❌ Failed {fname}: {msg}")
-                    self._update_row(fname, "Error", 0, 0)
-                elif filtered_df.empty:
-                    # --- NEW LOGIC: If result is empty, DO NOT SAVE ---
-                    self._log(f"⚠️ {fname}: 0 {filter_mode} tracks found. File Skipped.")
-                    self._update_row(fname, "Skipped (0)", count_orig, 0)
-                else:
-                    dest_folder = output_root / item["rel_path"].parent
-                    dest_folder.mkdir(parents=True, exist_ok=True)
-                    out_name = f"{item['rel_path'].stem}_{filter_mode}.csv"
-                    # Save WITHOUT index to preserve original structure (since we copied original)
-                    filtered_df.to_csv(dest_folder / out_name, index=False)
-                    self._log(f"✅ {fname}: {count_orig} -> {count_filt} tracks kept")
-                    self._update_row(fname, "Done", count_orig, count_filt)
-
-            if not self.stop_flag: 
+            # --- PIPELINED BATCH ---
+            # readers (I/O) -> preprocessors (CPU) -> this thread (model) ->
+            # writer (filter + CSV out), all linked by bounded queues so
+            # each stage overlaps the others instead of running in series.
+            GROUP_SIZE = 16
+            N_READ = 2
+            N_PRE = max(1, (os.cpu_count() or 2) // 2)
+
+            STOPPED = object()  # err marker for files dropped by a stop request
+
+            q_files = queue.Queue()
+            for item in self.items: q_files.put(item)
+            q_raw = queue.Queue(maxsize=4)   # (item, df_raw, err)
+            q_pre = queue.Queue(maxsize=4)   # (item, X_in, track_ids, df_raw, msg)
+            q_done = queue.Queue(maxsize=4)  # (item, df_raw, track_ids, probs, err)
+
+            def reader():
+                while not self.stop_flag:
+                    try: item = q_files.get_nowait()
+                    except queue.Empty: break
+                    fname = item["file_name"]
+                    self._update_row(fname, "Running...")
+                    self._log(f"⏳ Processing {fname}...")
+
+                    # Re-runs of unchanged files skip the whole pipeline
+                    hit, cached_csv, c_orig, c_filt = self.engine.cache_lookup(item["full_path"], filter_mode)
+                    if hit:
+                        try:
+                            if c_filt == 0:
+                                self._log(f"⚠️ {fname}: 0 {filter_mode} tracks found (cached). File Skipped.")
+                                self._update_row(fname, "Skipped (0)", c_orig, 0)
+                            else:
+                                dest_folder = output_root / item["rel_path"].parent
+                                dest_folder.mkdir(parents=True, exist_ok=True)
+                                shutil.copyfile(cached_csv, dest_folder / f"{item['rel_path'].stem}_{filter_mode}.csv")
+                                self._log(f"✅ {fname}: {c_orig} -> {c_filt} tracks kept (cached)")
+                                self._update_row(fname, "Done", c_orig, c_filt)
+                            continue
+                        except Exception as e:
+                            # Cached CSV vanished or isn't copyable —
+                            # treat as a miss and process normally
+                            self._log(f"⚠️ {fname}: cache copy failed ({e}). Reprocessing...")
+
+                    df_raw, msg = self.engine.read_file(item["full_path"])
+                    q_raw.put((item, df_raw, None if df_raw is not None else msg))
+
+            def preprocessor():
+                while True:
+                    rec = q_raw.get()
+                    if rec is None: break
+                    item, df_raw, err = rec
+                    if err is not None:
+                        q_pre.put((item, None, None, None, err)); continue
+                    if self.stop_flag:
+                        q_pre.put((item, None, None, None, STOPPED)); continue
+                    try:
+                        X_in, track_ids, _, msg = self.engine.preprocess_trajectory(df_raw)
+                    except Exception as e:
+                        X_in, track_ids, msg = None, None, f"Error: {str(e)}"
+                    q_pre.put((item, X_in, track_ids, df_raw, msg))
+
+            def writer():
+                while True:
+                    rec = q_done.get()
+                    if rec is None: break
+                    item, df_raw, track_ids, probs, err = rec
+                    fname = item["file_name"]
+                    if err is STOPPED:
+                        # Dropped by a stop request — not a failure
+                        self._update_row(fname, "Stopped")
+                        continue
+                    if err is not None:
+                        self._log(f"❌ Failed {fname}: {err}")
+                        self._update_row(fname, "Error", 0, 0)
+                        continue
+                    filtered_df, count_orig, count_filt, msg = self.engine.finalize_results(df_raw, track_ids, probs, filter_mode)
+                    if filtered_df is None:
+                        self._log(f"❌ Failed {fname}: {msg}")
+                        self._update_row(fname, "Error", 0, 0)
+                    elif filtered_df.empty:
+                        # --- NEW LOGIC: If result is empty, DO NOT SAVE ---
+                        self._log(f"⚠️ {fname}: 0 {filter_mode} tracks found. File Skipped.")
+                        self._update_row(fname, "Skipped (0)", count_orig, 0)
+                        self.engine.cache_store(item["full_path"], filter_mode, None, count_orig, 0)
+                    else:
+                        dest_folder = output_root / item["rel_path"].parent
+                        dest_folder.mkdir(parents=True, exist_ok=True)
+                        out_name = f"{item['rel_path'].stem}_{filter_mode}.csv"
+                        # Save WITHOUT index to preserve original structure (since we copied original)
+                        write_csv(filtered_df, dest_folder / out_name)
+                        self._log(f"✅ {fname}: {count_orig} -> {count_filt} tracks kept")
+                        self._update_row(fname, "Done", count_orig, count_filt)
+                        self.engine.cache_store(item["full_path"], filter_mode, filtered_df, count_orig, count_filt)
+
+            readers = [threading.Thread(target=reader, daemon=True) for _ in range(N_READ)]
+            pres = [threading.Thread(target=preprocessor, daemon=True) for _ in range(N_PRE)]
+            writer_t = threading.Thread(target=writer, daemon=True)
+            for t in readers + pres: t.start()
+            writer_t.start()
+
+            def close_raw():
+                # When all readers finish, release each preprocessor
+                for t in readers: t.join()
+                for _ in pres: q_raw.put(None)
+            threading.Thread(target=close_raw, daemon=True).start()
+
+            def close_pre():
+                for t in pres: t.join()
+                q_pre.put(None)
+            threading.Thread(target=close_pre, daemon=True).start()
+
+            # Inference stage (this thread): gather files into groups and
+            # run ONE predict per group to amortize Keras call overhead.
+            done = False      # Sentinel seen — pipeline fully drained
+            aborted = False   # Model blew up — stop predicting
+            crit_msg = None
+            while not done and not aborted:
+                rec = q_pre.get()
+                if rec is None: done = True; break
+                batch = [rec]
+                while len(batch) < GROUP_SIZE:
+                    try: nxt = q_pre.get_nowait()
+                    except queue.Empty: break
+                    if nxt is None: done = True; break
+                    batch.append(nxt)
+
+                good = [rec for rec in batch if rec[1] is not None and not self.stop_flag]
+                probs_by_file, pmsg = [], None
+                if good:
+                    probs_by_file, pmsg = self.engine.predict_batch([rec[1] for rec in good])
+                    if probs_by_file is None:
+                        self._log(f"❌ CRITICAL ERROR: {pmsg}")
+                        aborted, crit_msg = True, pmsg
+                        probs_by_file = [None] * len(good)
+
+                good_iter = iter(zip(good, probs_by_file))
+                for item, X_in, track_ids, df_raw, msg in batch:
+                    if X_in is None:
+                        q_done.put((item, None, None, None, msg))
+                        continue
+                    if self.stop_flag:
+                        q_done.put((item, None, None, None, STOPPED))
+                        continue
+                    _, probs = next(good_iter)
+                    if probs is None:
+                        q_done.put((item, None, None, None, pmsg))
+                    else:
+                        q_done.put((item, df_raw, track_ids, probs, None))
+
+            if aborted and not done:
+                # Keep consuming until the sentinel so preprocessors never
+                # block on the bounded queue; every remaining file still
+                # reaches a terminal state via the writer.
+                while True:
+                    rec = q_pre.get()
+                    if rec is None: break
+                    item, X_in, _, _, msg = rec
+                    if X_in is None:
+                        q_done.put((item, None, None, None, msg))
+                    elif self.stop_flag:
+                        q_done.put((item, None, None, None, STOPPED))
+                    else:
+                        q_done.put((item, None, None, None, crit_msg))
+
+            q_done.put(None)
+            writer_t.join()
+
+            if self.stop_flag: self._log("🛑 Batch stopped by user.")
+
+            if aborted:
+                self._log("❌ --- Batch Aborted ---")
+                self.after(0, lambda: messagebox.showerror("Error", f"Batch aborted:\n{crit_msg}"))
+            elif self.stop_flag:
+                self.after(0, lambda: messagebox.showinfo("Stopped", "Processing stopped by user."))
+            else:
                 self._log("🎉 --- Batch Complete ---")
-                messagebox.showinfo("Done", f"Analysis complete.\nSaved to: {output_root}")
-            else: messagebox.showinfo("Stopped", "Processing stopped by user.")
-            self._reset_buttons()
+                self.after(0, lambda: messagebox.showinfo("Done", f"Analysis complete.\nSaved to: {output_root}"))
+            self.after(0, self._reset_buttons)
 
         threading.Thread(target=worker, daemon=True).start()
 
@@ -1,135 +1,404 @@
 import os
+import json
+import hashlib
+import functools
+import threading
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from tensorflow import keras
 
 # Suppress TF logs
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+# PyArrow is optional — its multithreaded CSV parser is much faster than pandas
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+    _HAS_ARROW = True
+except ImportError:
+    _HAS_ARROW = False
+
+def _read_csv(file_path):
+    """Reads a tracking CSV. Prefers Arrow's parallel parser, falls back
+    to pandas for anything Arrow can't digest (odd delimiters etc.)."""
+    if _HAS_ARROW:
+        try:
+            tbl = pacsv.read_csv(file_path, read_options=pacsv.ReadOptions(block_size=8 << 20))
+            return tbl.to_pandas(self_destruct=True)
+        except Exception:
+            pass  # Fall through to pandas
+    return pd.read_csv(file_path)
+
+def write_csv(df, path):
+    """Writes a dataframe without its index. Arrow's multithreaded C++
+    writer beats pandas' to_csv by a wide margin on big files."""
+    if _HAS_ARROW:
+        try:
+            pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), str(path))
+            return
+        except Exception:
+            pass  # Fall through to pandas
+    df.to_csv(path, index=False)
+
+# Candidate header names, lowercased once at import time
+_TRACK_CANDIDATES = ['trajectory', 'track id', 'trackid', 'track', 'spot id', 'particle id']
+_FRAME_CANDIDATES = ['frame', 'frame id', 'slice', 'time', 't']
+_X_CANDIDATES = ['x', 'xpx', 'position x', 'x (um)', 'x (px)']
+_Y_CANDIDATES = ['y', 'ypx', 'position y', 'y (um)', 'y (px)']
+
+def _find_column(columns, candidates):
+    """Finds a column name (case-insensitive); candidates are lowercase."""
+    # 1. Exact match
+    for col in columns:
+        if str(col).lower().strip() in candidates:
+            return col
+    # 2. Partial match
+    for col in columns:
+        low = str(col).lower()
+        for cand in candidates:
+            if cand in low:
+                return col
+    return None
+
+@functools.lru_cache(maxsize=32)
+def _detect_columns(cols_tuple):
+    """Returns (track_col, frame_col, x_col, y_col) for a header layout.
+    Cached — within one batch every CSV usually shares the same header,
+    so the substring scans run only for the first file."""
+    return (_find_column(cols_tuple, _TRACK_CANDIDATES),
+            _find_column(cols_tuple, _FRAME_CANDIDATES),
+            _find_column(cols_tuple, _X_CANDIDATES),
+            _find_column(cols_tuple, _Y_CANDIDATES))
+
+@functools.lru_cache(maxsize=8)
+def _model_hash(model_path):
+    """SHA1 of the model file, cached so we hash the weights only once."""
+    h = hashlib.sha1()
+    with open(model_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _build_inputs_numpy(frames_s, xs_s, starts, counts, valid, t_uniform, out_diff):
+    """Vectorized fallback for the Numba kernel. Shifts every track's
+    times into a disjoint, globally increasing window so a SINGLE
+    np.searchsorted over the whole file replaces N per-track np.interp
+    calls; then one broadcasted lerp + diff finishes the job."""
+    v_idx = np.flatnonzero(valid)
+    elem = np.repeat(valid, counts)
+    fr = frames_s[elem].astype(np.float64)  # float64: the cumsum offsets get big
+    xv = xs_s[elem]
+    cnts = counts[v_idx]
+    strts = np.concatenate(([0], np.cumsum(cnts)[:-1]))
+
+    t0 = fr[strts]
+    span = fr[strts + cnts - 1] - t0
+    base = np.concatenate(([0.0], np.cumsum(span + 1.0)[:-1]))
+    # Single fused shift: raw times go straight into the search grid,
+    # no [0,1] normalization pass anywhere
+    shifted = fr + np.repeat(base - t0, cnts)
+
+    target_frames = t_uniform.size
+    q = (base[:, None] + span[:, None] * t_uniform[None, :]).ravel()
+
+    j = np.searchsorted(shifted, q, side="right") - 1
+    j = np.clip(j, np.repeat(strts, target_frames), np.repeat(strts + cnts - 2, target_frames))
+    ta, tb = shifted[j], shifted[j + 1]
+    denom = np.where(tb > ta, tb - ta, 1.0)
+    w = np.where(tb > ta, (q - ta) / denom, 0.0)
+    vals = (xv[j] + w * (xv[j + 1] - xv[j])).reshape(len(v_idx), target_frames)
+    out_diff[v_idx, :, 0] = np.diff(vals, axis=1)
+
+# Numba is optional — the engine falls back to plain NumPy without it
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
+if _HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _build_inputs(frames_s, xs_s, starts, counts, valid, target_frames, out_diff):
+        """Linear-interp each track onto a uniform grid and write the
+        frame-to-frame differences straight into out_diff (n, 299, 1).
+        Same semantics as np.interp + np.diff, parallel across tracks."""
+        for i in prange(starts.shape[0]):
+            if not valid[i]: continue
+            s = starts[i]
+            c = counts[i]
+            t0 = frames_s[s]
+            t1 = frames_s[s + c - 1]
+            interp = np.empty(target_frames, dtype=np.float32)
+            j = s
+            for k in range(target_frames):
+                tq = t0 + (t1 - t0) * k / (target_frames - 1)
+                while j + 2 < s + c and frames_s[j + 1] < tq:
+                    j += 1
+                ta = frames_s[j]
+                tb = frames_s[j + 1]
+                if tb == ta:
+                    interp[k] = xs_s[j]
+                else:
+                    w = (tq - ta) / (tb - ta)
+                    interp[k] = xs_s[j] + w * (xs_s[j + 1] - xs_s[j])
+            for k in range(target_frames - 1):
+                out_diff[i, k, 0] = interp[k + 1] - interp[k]
+
 class MoNetEngine:
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         self.model = None
+        self.interp = None  # TFLite interpreter (preferred when a .tflite exists)
+        self._loaded_path = None
         self.target_frames = 300
+        # Loop-invariant: same query grid for every track in every file
+        self._t_uniform = np.linspace(0.0, 1.0, self.target_frames)
+        self.cache_dir = cache_dir  # Result cache disabled when None
+        self.load_event = threading.Event()  # Set whenever a load attempt finishes
+
+    def is_loaded(self):
+        return self.model is not None or self.interp is not None
 
     def load_model(self, model_path):
         try:
-            self.model = keras.models.load_model(model_path, compile=False)
+            return self._load_model(model_path)
+        finally:
+            self.load_event.set()
+
+    def _load_model(self, model_path):
+        # Already have this model? Skip the multi-second reload.
+        if self.is_loaded() and self._loaded_path == model_path:
+            return True, "Model already loaded."
+        try:
+            # Prefer a quantized .tflite sitting next to the .h5 — the
+            # MoNet CNN is small and runs 3-6x faster through TFLite on CPU
+            tflite_path = os.path.splitext(model_path)[0] + ".tflite"
+            if os.path.exists(tflite_path):
+                self.interp = tf.lite.Interpreter(model_path=tflite_path, num_threads=os.cpu_count())
+                self.interp.allocate_tensors()
+                self.model = None
+            else:
+                self.model = keras.models.load_model(model_path, compile=False)
+                self.interp = None
+            self._loaded_path = model_path
+            # Warm up graph tracing/cuDNN so the first real file isn't slow
+            self._predict(np.zeros((1, self.target_frames - 1, 1), np.float32))
             return True, "Model loaded successfully."
         except Exception as e:
+            self.model = None
+            self.interp = None
+            self._loaded_path = None
             return False, f"Error loading model: {str(e)}"
 
-    def _find_column(self, columns, candidates):
-        """Finds column name (case-insensitive) and returns (Name, Index)."""
-        # 1. Exact match
-        for idx, col in enumerate(columns):
-            if str(col).lower().strip() in [c.lower() for c in candidates]:
-                return col, idx
-        # 2. Partial match
-        for idx, col in enumerate(columns):
-            for cand in candidates:
-                if cand.lower() in str(col).lower():
-                    return col, idx
-        return None, None
+    def convert_to_tflite(self, model_path, representative_dataset=None):
+        """One-time conversion of the .h5 model to .tflite. INT8 when a
+        representative dataset generator is given, FP16 otherwise.
+        Returns (success, tflite_path_or_error)."""
+        try:
+            model = keras.models.load_model(model_path, compile=False)
+            converter = tf.lite.TFLiteConverter.from_keras_model(model)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if representative_dataset is not None:
+                converter.representative_dataset = representative_dataset
+            else:
+                converter.target_spec.supported_types = [tf.float16]
+            tflite_path = os.path.splitext(model_path)[0] + ".tflite"
+            with open(tflite_path, "wb") as f:
+                f.write(converter.convert())
+            return True, tflite_path
+        except Exception as e:
+            return False, f"Error converting model: {str(e)}"
+
+    def _predict(self, X):
+        """Runs whichever backend is loaded on a (n, 299, 1) batch."""
+        if self.interp is not None:
+            inp = self.interp.get_input_details()[0]
+            if inp['shape'][0] != X.shape[0]:
+                # TFLite tensors are fixed-size; resize per batch
+                self.interp.resize_tensor_input(inp['index'], list(X.shape))
+                self.interp.allocate_tensors()
+                inp = self.interp.get_input_details()[0]
+            self.interp.set_tensor(inp['index'], np.ascontiguousarray(X, dtype=np.float32))
+            self.interp.invoke()
+            return self.interp.get_tensor(self.interp.get_output_details()[0]['index'])
+        return self.model.predict(X, batch_size=1024, verbose=0)
 
     def preprocess_trajectory(self, df_raw):
-        # WORK ON A COPY to avoid messing up original headers
-        df = df_raw.copy()
-        
-        # Clean headers for internal processing ONLY
-        df.columns = [str(c).strip() for c in df.columns]
-        cols = df.columns
-        
-        # --- SMART COLUMN DETECTION ---
-        track_candidates = ['Trajectory', 'Track ID', 'TrackID', 'Track', 'Spot ID', 'Particle ID']
-        track_col, _ = self._find_column(cols, track_candidates)
-
-        frame_candidates = ['Frame', 'Frame ID', 'Slice', 'Time', 't']
-        frame_col, _ = self._find_column(cols, frame_candidates)
-
-        x_candidates = ['x', 'xpx', 'Position X', 'X (um)', 'X (px)']
-        x_col, _ = self._find_column(cols, x_candidates)
-        
-        y_candidates = ['y', 'ypx', 'Position Y', 'Y (um)', 'Y (px)']
-        y_col, _ = self._find_column(cols, y_candidates)
+        # NO COPY — we only need the header names and three numeric
+        # columns, so clean the names alone and leave df_raw untouched
+        stripped = tuple(str(c).strip() for c in df_raw.columns)
+
+        # --- SMART COLUMN DETECTION (cached per header layout) ---
+        # Fast path: conformant MoNet/MPTHub headers skip detection entirely
+        if {"Trajectory", "Frame", "x", "y"} <= set(stripped):
+            track_col, frame_col, x_col, y_col = "Trajectory", "Frame", "x", "y"
+        else:
+            track_col, frame_col, x_col, y_col = _detect_columns(stripped)
 
         if not all([track_col, frame_col, x_col, y_col]):
             return None, None, None, f"Missing columns. Found: {track_col}, {frame_col}"
 
-        # --- EXTRACT DATA ---
-        xs_list, ys_list, ids_list = [], [], []
+        # Map the detected (stripped) names back onto the raw header
+        raw_name = dict(zip(stripped, df_raw.columns))
 
-        for tid, g in df.groupby(track_col):
-            g = g.sort_values(frame_col)
-            
-            # Normalize Time
-            t_raw = g[frame_col].to_numpy().astype(float)
-            t = t_raw - t_raw.min()
-            
-            if len(t) < 3 or t.max() == 0: continue
+        # --- EXTRACT DATA (vectorized) ---
+        # One lexsort over the whole file replaces thousands of tiny
+        # groupby/sort_values calls; tracks become contiguous segments.
+        # float32 end-to-end: half the memory traffic, and the model
+        # wants float32 input anyway
+        ids_arr = df_raw[raw_name[track_col]].to_numpy()
+        frames = df_raw[raw_name[frame_col]].to_numpy(dtype=np.float32)
+        xs = df_raw[raw_name[x_col]].to_numpy(dtype=np.float32)
 
-            t /= t.max()
-            t_uniform = np.linspace(0, 1, self.target_frames)
-            
-            try:
-                # Interpolate
-                x_vals = g[x_col].to_numpy().astype(float)
-                y_vals = g[y_col].to_numpy().astype(float)
-                
-                xs_list.append(np.interp(t_uniform, t, x_vals))
-                ys_list.append(np.interp(t_uniform, t, y_vals))
-                ids_list.append(tid)
-            except: continue
+        order = np.lexsort((frames, ids_arr))
+        ids_s, frames_s, xs_s = ids_arr[order], frames[order], xs[order]
 
-        if not xs_list: 
+        # ids_s is already sorted, so segment boundaries come from one
+        # neighbour comparison — no need for np.unique's internal re-sort
+        boundary = np.empty(len(ids_s), dtype=bool)
+        boundary[0] = True
+        np.not_equal(ids_s[1:], ids_s[:-1], out=boundary[1:])
+        starts = np.flatnonzero(boundary)
+        counts = np.diff(np.append(starts, len(ids_s)))
+        uniq = ids_s[starts]
+
+        n_tracks = len(uniq)
+        # Valid = at least 3 points and a non-zero time span
+        valid = (counts >= 3) & (frames_s[starts + counts - 1] > frames_s[starts])
+
+        if not valid.any():
             return None, None, [], "0 valid tracks found (check lengths)."
 
-        X_arr = np.array(xs_list)
-        X_in = np.diff(X_arr, axis=1)[:, :, np.newaxis]
-        
-        # Return the INPUT df (copy) just for column name reference if needed
-        return X_in, ids_list, df, "Success"
+        out_diff = np.empty((n_tracks, self.target_frames - 1, 1), dtype=np.float32)
 
-    def run_inference(self, file_path, filter_type="All"):
+        if _HAS_NUMBA:
+            _build_inputs(frames_s, xs_s, starts, counts, valid, self.target_frames, out_diff)
+        else:
+            _build_inputs_numpy(frames_s, xs_s, starts, counts, valid, self._t_uniform, out_diff)
+
+        ids_list = list(uniq[valid])
+        X_in = out_diff[valid]
+
+        return X_in, ids_list, df_raw, "Success"
+
+    def _cache_key(self, file_path, filter_mode):
+        st = os.stat(file_path)
+        model_sha = _model_hash(self._loaded_path) if self._loaded_path else ""
+        raw = f"{file_path}|{st.st_mtime_ns}|{st.st_size}|{model_sha}|{filter_mode}"
+        return hashlib.blake2b(raw.encode()).hexdigest()[:16]
+
+    def cache_lookup(self, file_path, filter_mode):
+        """Checks the disk cache for a previous run of this exact
+        (file, model, filter) combo. Returns (hit, cached_csv_path,
+        count_orig, count_filt); cached_csv_path is None when the hit
+        was an empty/skipped result."""
+        if self.cache_dir is None: return False, None, 0, 0
         try:
-            # Read CSV
-            df_raw = pd.read_csv(file_path)
-            if df_raw.empty: return None, 0, 0, "File is empty."
+            key = self._cache_key(file_path, filter_mode)
+            meta_path = os.path.join(self.cache_dir, key + ".json")
+            if not os.path.exists(meta_path): return False, None, 0, 0
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            csv_path = os.path.join(self.cache_dir, key + ".csv")
+            if meta["count_filt"] == 0:
+                return True, None, meta["count_orig"], 0
+            if os.path.exists(csv_path):
+                return True, csv_path, meta["count_orig"], meta["count_filt"]
+        except Exception:
+            pass  # Corrupt/unreadable cache entry — treat as a miss
+        return False, None, 0, 0
 
-            # 1. Preprocess (Pass raw, it makes a copy)
+    def cache_store(self, file_path, filter_mode, filtered_df, count_orig, count_filt):
+        """Best-effort write of a finished result into the disk cache."""
+        if self.cache_dir is None: return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            key = self._cache_key(file_path, filter_mode)
+            if filtered_df is not None and not filtered_df.empty:
+                write_csv(filtered_df, os.path.join(self.cache_dir, key + ".csv"))
+            with open(os.path.join(self.cache_dir, key + ".json"), "w") as f:
+                json.dump({"count_orig": count_orig, "count_filt": count_filt}, f)
+        except Exception:
+            pass  # Never fail a batch over the cache
+
+    def read_file(self, file_path):
+        """Reads one tracking CSV. Returns (df_raw, msg) — None on failure."""
+        try:
+            df_raw = _read_csv(file_path)
+            if df_raw.empty: return None, "File is empty."
+            return df_raw, "Success"
+        except Exception as e:
+            return None, f"Error: {str(e)}"
+
+    def preprocess_only(self, file_path):
+        """Reads + preprocesses one CSV without touching the model.
+        Returns (X_in, track_ids, df_raw, msg) — X_in is None on failure."""
+        df_raw, msg = self.read_file(file_path)
+        if df_raw is None: return None, None, None, msg
+
+        try:
             X_in, track_ids, df_clean_ref, msg = self.preprocess_trajectory(df_raw)
-            
-            if X_in is None: return None, 0, 0, msg
+            if X_in is None: return None, None, None, msg
+        except Exception as e:
+            return None, None, None, f"Error: {str(e)}"
 
-            if self.model is None: return None, 0, 0, "Model not loaded."
-                
-            # 2. Predict
-            probs = self.model.predict(X_in, verbose=0)
+        return X_in, track_ids, df_raw, "Success"
+
+    def predict_batch(self, list_of_Xin):
+        """Runs ONE model.predict over many files' inputs and splits back.
+        Amortizes per-call Keras overhead across the whole group."""
+        if not self.is_loaded(): return None, "Model not loaded."
+        try:
+            counts = [x.shape[0] for x in list_of_Xin]
+            X_all = np.concatenate(list_of_Xin, axis=0)
+            probs_all = self._predict(X_all)
+            # Split back into per-file chunks by original track counts
+            splits = np.cumsum(counts)[:-1]
+            return np.split(probs_all, splits), "Success"
+        except Exception as e:
+            return None, f"Error: {str(e)}"
+
+    def finalize_results(self, df_raw, track_ids, probs, filter_type="All"):
+        """Turns raw predictions into the filtered original dataframe.
+        Returns (filtered_df, original_count, kept_count, msg)."""
+        try:
             labels_map = ["Brownian", "FBM", "CTRW"]
-            pred_labels = [labels_map[i] for i in probs.argmax(axis=1)]
 
-            # 3. Create Results
-            results = pd.DataFrame({"Trajectory": track_ids, "MoNet_Label": pred_labels})
-            original_count = len(track_ids)
-            
-            # 4. Filter
-            if filter_type != "All":
-                results = results[results["MoNet_Label"] == filter_type]
-            
-            if results.empty:
-                return pd.DataFrame(), original_count, 0, f"No {filter_type} tracks."
+            # Cleaned header names for column mapping — names only, the
+            # frame itself is never copied
+            clean_cols = [str(c).strip().lower() for c in df_raw.columns]
+
+            # Label filter in pure NumPy — no intermediate results frame.
+            # track_ids are already unique per file.
+            labels = probs.argmax(axis=1)
+            track_arr = np.asarray(track_ids)
+            original_count = len(track_arr)
 
-            valid_ids = results["Trajectory"].unique()
+            if filter_type == "All":
+                valid_ids = track_arr
+            elif filter_type in labels_map:
+                valid_ids = track_arr[labels == labels_map.index(filter_type)]
+            else:
+                valid_ids = track_arr[:0]
+
+            if valid_ids.size == 0:
+                return pd.DataFrame(), original_count, 0, f"No {filter_type} tracks."
             
             # --- CRITICAL: FILTER THE ORIGINAL DATAFRAME (PRESERVING HEADERS) ---
             
             # We need to find which column in df_raw corresponds to the Track ID
-            # We use the cleaned reference to find the index, then map to raw.
-            clean_track_col = next(c for c in df_clean_ref.columns if str(c).strip().lower() in ['trajectory', 'track id', 'trackid', 'track'])
-            col_idx = df_clean_ref.columns.get_loc(clean_track_col)
+            # We use the cleaned names to find the index, then map to raw.
+            col_idx = next(i for i, c in enumerate(clean_cols) if c in ['trajectory', 'track id', 'trackid', 'track'])
             raw_track_col = df_raw.columns[col_idx] # This has the original spaces/formatting
             
-            # Filter
-            original_df_filtered = df_raw[df_raw[raw_track_col].isin(valid_ids)].copy()
+            # Filter — sorted IDs + searchsorted beats .isin's hash path,
+            # and take() hands back a fresh frame without an extra copy()
+            ids_arr = df_raw[raw_track_col].to_numpy()
+            valid_sorted = np.sort(np.asarray(valid_ids))
+            idx = np.searchsorted(valid_sorted, ids_arr)
+            idx = np.clip(idx, 0, valid_sorted.size - 1)
+            mask = valid_sorted[idx] == ids_arr
+            original_df_filtered = df_raw.take(np.flatnonzero(mask))
 
             # --- CRITICAL FIX: FORCE INTEGERS ---
             # If pandas read "1" as "1.0", convert it back to "1" to satisfy MPTHub
@@ -138,8 +407,7 @@ class MoNetEngine:
                      original_df_filtered[raw_track_col] = original_df_filtered[raw_track_col].astype(int)
                      
                 # Do the same for Frame column if possible
-                clean_frame_col = next(c for c in df_clean_ref.columns if str(c).strip().lower() in ['frame', 'frame id', 't'])
-                frame_idx = df_clean_ref.columns.get_loc(clean_frame_col)
+                frame_idx = next(i for i, c in enumerate(clean_cols) if c in ['frame', 'frame id', 't'])
                 raw_frame_col = df_raw.columns[frame_idx]
                 
                 if original_df_filtered[raw_frame_col].dtype == float:
@@ -147,7 +415,20 @@ class MoNetEngine:
             except:
                 pass # If conversion fails (e.g. strings), leave it alone
 
-            return original_df_filtered, original_count, len(results), "Success"
+            return original_df_filtered, original_count, int(valid_ids.size), "Success"
 
         except Exception as e:
-            return None, 0, 0, f"Error: {str(e)}"
\ No newline at end of file
+            return None, 0, 0, f"Error: {str(e)}"
+
+    def run_inference(self, file_path, filter_type="All"):
+        """Single-file path (kept for convenience); batch runs use
+        preprocess_only / predict_batch / finalize_results directly."""
+        X_in, track_ids, df_raw, msg = self.preprocess_only(file_path)
+        if X_in is None: return None, 0, 0, msg
+
+        if not self.is_loaded(): return None, 0, 0, "Model not loaded."
+
+        probs_list, msg = self.predict_batch([X_in])
+        if probs_list is None: return None, 0, 0, msg
+
+        return self.finalize_results(df_raw, track_ids, probs_list[0], filter_type)
\ No newline at end of file